@@ -1,13 +1,20 @@
 # automation_print_to_pdf.py
+import asyncio
 import base64
 import os
+import random
+import re
+import smtplib
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from email.message import EmailMessage
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 from pathlib import Path
 
 import win32com.client
-from playwright.sync_api import sync_playwright, expect, TimeoutError as PWTimeoutError
+from playwright.async_api import async_playwright, expect, TimeoutError as PWTimeoutError
 
 PRES_URL = os.environ["PRES_URL"]
 RECIPIENT = os.environ["RECIPIENT"]
@@ -15,31 +22,327 @@ SUBJECT = os.environ["SUBJECT"]
 
 MAX_RETRIES = int(os.environ["MAX_RETRIES"])
 RETRY_DELAY_SECONDS = int(os.environ["RETRY_DELAY_SECONDS"])
+RETRY_MAX_DELAY_SECONDS = int(os.environ.get("RETRY_MAX_DELAY_SECONDS", "300"))
+
+_IL_TZ = ZoneInfo("Asia/Jerusalem")
+
+PDF_STREAM_CHUNK_SIZE = 256 * 1024
+
+# one page setup for every print path: A4, 5mm margins, no backgrounds.
+# The explicit paper size matches the injected @page rule, so Chrome doesn't
+# re-paginate Stimulsoft's fixed-size page divs.
+PDF_PRINT_CSS = (
+    "@page { size: A4; margin: 5mm; } "
+    "body { margin: 0 !important; } "
+    ".stiJsViewerReportPanel { break-inside: avoid; }"
+)
+PDF_MARGIN_IN = 0.2
+CDP_PDF_PARAMS = {
+    "printBackground": False,
+    "preferCSSPageSize": True,
+    "paperWidth": 8.27,
+    "paperHeight": 11.69,
+    "marginTop": PDF_MARGIN_IN,
+    "marginBottom": PDF_MARGIN_IN,
+    "marginLeft": PDF_MARGIN_IN,
+    "marginRight": PDF_MARGIN_IN,
+}
+
+# how the extracted report is rendered: "pdf" (Chrome printToPDF, default),
+# "mhtml" (Page.captureSnapshot, archival only) or "weasyprint" (external CLI)
+PDF_ENGINES = {"pdf", "mhtml", "weasyprint"}
+PDF_ENGINE = os.environ.get("PDF_ENGINE", "pdf").lower()
+if PDF_ENGINE not in PDF_ENGINES:
+    raise ValueError(f"Unknown PDF_ENGINE {PDF_ENGINE!r}; expected one of {', '.join(sorted(PDF_ENGINES))}")
+
+# decodes + writes PDF chunks off the event loop (one worker per report)
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+
+# filterLocations values included in both reports
+REPORT_LOCATIONS = ["1181", "1178", "1170", "1350", "1174", "1175", "1176", "1173"]
+
+# the login page's own "wrong credentials" message; only this makes a failed
+# login fatal (override with PRES_LOGIN_ERROR_PATTERN if the wording changes)
+LOGIN_ERROR_RE = re.compile(
+    os.environ.get("PRES_LOGIN_ERROR_PATTERN", r"שגוי|לא נכונ|לא תקינ|incorrect|invalid"),
+    re.IGNORECASE,
+)
+
+# logged-in cookies/localStorage, reused across retries and runs
+AUTH_STATE_PATH = Path(os.environ.get("PRES_AUTH_STATE", ".auth/pres.json"))
+AUTH_STATE_MAX_AGE_HOURS = float(os.environ.get("PRES_AUTH_MAX_AGE_HOURS", "8"))
+
+
+# requests the report pages don't need; aborting them speeds up rendering
+BLOCKED_RESOURCE_TYPES = {"font", "media"}
+BLOCKED_HOSTS = (
+    "fonts.googleapis.com",
+    "fonts.gstatic.com",
+    "google-analytics.com",
+    "googletagmanager.com",
+    "doubleclick.net",
+)
+
+
+# trims Chromium startup and print-to-PDF overhead in headless mode
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-translate",
+    "--mute-audio",
+    "--font-render-hinting=none",
+    "--disable-features=IsolateOrigins,site-per-process",
+]
+
+
+# records performance.mark() calls so print stage timings can be logged
+# (wrapped in an IIFE so nothing leaks into the site's global scope)
+_PERF_MARKS_JS = """
+(() => {
+    if (window.__marks) return;
+    window.__marks = [];
+    const mark = performance.mark.bind(performance);
+    performance.mark = (name, ...rest) => {
+        window.__marks.push([name, performance.now()]);
+        return mark(name, ...rest);
+    };
+})();
+"""
+
+
+# ---- in-page JS, parsed once per document via add_init_script ----
+_SETUP_AND_OPEN_FUNC = """({ locs, date, posClasses }) => {
+    // flip every option in one pass and notify the page once (and only
+    // if something changed), instead of one change event per option
+    const selectValues = (name, values) => {
+        const s = document.querySelector(`select[name="${name}"]`);
+        if (!s) throw new Error("Select not found: " + name);
+        const wanted = new Set(values);
+        const available = new Set([...s.options].map(o => o.value));
+        const absent = [...wanted].filter(v => !available.has(v));
+        if (absent.length) throw new Error(`Options not found in ${name}: ${absent.join(', ')}`);
+        let changed = false;
+        for (const o of s.options) {
+            const sel = wanted.has(o.value);
+            if (o.selected !== sel) {
+                o.selected = sel;
+                changed = true;
+            }
+        }
+        if (changed) {
+            s.dispatchEvent(new Event('input', { bubbles: true }));
+            s.dispatchEvent(new Event('change', { bubbles: true }));
+        }
+    };
+    const setDate = (name, val) => {
+        const el = document.querySelector(`input[name="${name}"]`);
+        if (!el) throw new Error("Date input not found: " + name);
+        el.focus();
+        el.value = val;
+        el.dispatchEvent(new Event('input', { bubbles: true }));
+        el.dispatchEvent(new Event('change', { bubbles: true }));
+        el.blur();
+        return el.value;
+    };
+
+    selectValues('filterLocations', locs);
+    const start = setDate('startDatePicker', date);
+    const end = setDate('endDatePicker', date);
+    selectValues('posClasses', posClasses);
+
+    // link text is an icon glyph followed by the label
+    const link = [...document.querySelectorAll('#report-criteria a')]
+        .find(a => a.textContent.trim().endsWith('הצג דוח'));
+    if (!link) throw new Error("Show report link not found");
+    link.click();
+    return [start, end];
+}"""
+
+# polled before __setupAndOpen: both selects have every requested option and
+# the "show report" link is rendered (what select_option/click used to wait for)
+_SETUP_READY_JS = """({ locs, posClasses }) => {
+    const hasAll = (name, values) => {
+        const s = document.querySelector(`select[name="${name}"]`);
+        if (!s) return false;
+        const available = new Set([...s.options].map(o => o.value));
+        return values.every(v => available.has(v));
+    };
+    const link = [...document.querySelectorAll('#report-criteria a')]
+        .find(a => a.textContent.trim().endsWith('הצג דוח'));
+    return hasAll('filterLocations', locs)
+        && hasAll('posClasses', posClasses)
+        && !!link && link.offsetParent !== null
+        && link.getAttribute('aria-disabled') !== 'true';
+}"""
+
+_ADOPT_PRINT_FRAME_FUNC = """() => {
+    const f = document.getElementById('stiPrintReportFrame');
+    const d = f && f.contentDocument;
+    if (!d || !d.documentElement) return false;
+    document.replaceChild(document.adoptNode(d.documentElement), document.documentElement);
+    return true;
+}"""
+
+_BLOB_PDF_FUNC = """async () => {
+    const el = document.querySelector('embed[src^="blob:"], object[data^="blob:"], iframe[src^="blob:"]');
+    const url = el ? (el.src || el.data) : (location.href.startsWith('blob:') ? location.href : null);
+    if (!url) return null;
+    const bytes = new Uint8Array(await (await fetch(url)).arrayBuffer());
+    let bin = '';
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        bin += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+    }
+    return btoa(bin);
+}"""
+
+# polled by wait_for_function, so it stays a plain predicate
+_PRINT_READY_JS = """(isPopup) => {
+    const f = document.getElementById('stiPrintReportFrame');
+    if (f) {
+        const d = f.contentDocument;
+        return !!(d && d.readyState === 'complete' && d.body && d.body.innerHTML.length > 5000);
+    }
+    return isPopup && !!document.querySelector('embed, object, iframe');
+}"""
+
+_PAGE_HELPERS_JS = (
+    "window.__setupAndOpen = " + _SETUP_AND_OPEN_FUNC + ";\n"
+    "window.__adoptPrintFrame = " + _ADOPT_PRINT_FRAME_FUNC + ";\n"
+    "window.__blobPdfBase64 = " + _BLOB_PDF_FUNC + ";\n"
+)
+
+
+class AuthError(RuntimeError):
+    """Login failed or the saved session is no longer accepted."""
+
+
+class LoginError(AuthError):
+    """The site rejected the configured credentials."""
+
+
+class PrintError(RuntimeError):
+    """The print step itself failed (as opposed to login or navigation)."""
+
+
+class ConfigError(RuntimeError):
+    """A required environment variable is missing."""
+
+
+# retrying can't fix these: bad credentials (missing config is caught before
+# the first attempt by check_config)
+FATAL_ERRORS = (LoginError,)
+
+REQUIRED_ENV = ["PRES_POS_CODE", "NLC_USER", "NLC_PASSWORD"]
+
+
+def check_config() -> None:
+    required = list(REQUIRED_ENV)
+    if os.environ.get("SMTP_HOST") and os.environ.get("SMTP_USER"):
+        required.append("SMTP_PASS")
+    missing = [name for name in required if not os.environ.get(name)]
+    if os.environ.get("SMTP_HOST") and not (os.environ.get("SMTP_SENDER") or os.environ.get("SMTP_USER")):
+        missing.append("SMTP_SENDER (or SMTP_USER)")
+    if missing:
+        raise ConfigError(f"Missing environment variables: {', '.join(missing)}")
+
+
+def _fresh_auth_state() -> Path | None:
+    if not AUTH_STATE_PATH.exists():
+        return None
+    age_hours = (time.time() - AUTH_STATE_PATH.stat().st_mtime) / 3600
+    return AUTH_STATE_PATH if age_hours < AUTH_STATE_MAX_AGE_HOURS else None
+
+
+async def _route_nonessential(route) -> None:
+    request = route.request
+    url = request.url.lower()
+    if any(host in url for host in BLOCKED_HOSTS) or (
+        request.resource_type in BLOCKED_RESOURCE_TYPES and "stimulsoft" not in url
+    ):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+async def new_context(browser, storage_state=None):
+    context = await browser.new_context(
+        viewport={"width": 1400, "height": 900},
+        accept_downloads=True,
+        storage_state=storage_state,
+    )
+    await context.route("**/*", _route_nonessential)
+    return context
 
 
 def yesterday_str_il(fmt: str = "%d/%m/%Y") -> str:
-    y = datetime.now(ZoneInfo("Asia/Jerusalem")).date() - timedelta(days=1)
+    y = datetime.now(_IL_TZ).date() - timedelta(days=1)
     return y.strftime(fmt)
 
-def set_date_input(page, selector: str, value: str) -> None:
-    # set value + dispatch events so site commits it
-    page.evaluate(
-        """([sel, val]) => {
-            const el = document.querySelector(sel);
-            if (!el) throw new Error("Date input not found: " + sel);
-            el.focus();
-            el.value = val;
-            el.dispatchEvent(new Event('input', { bubbles: true }));
-            el.dispatchEvent(new Event('change', { bubbles: true }));
-            el.blur();
-        }""",
-        [selector, value],
+async def setup_and_open_report(
+    page,
+    locations: list[str],
+    date_str: str,
+    pos_classes: list[str],
+    label: str,
+) -> None:
+    # options may load asynchronously; wait for them instead of failing fast.
+    # On timeout __setupAndOpen still runs and reports what is missing.
+    try:
+        await page.wait_for_function(
+            _SETUP_READY_JS,
+            arg={"locs": locations, "posClasses": pos_classes},
+            timeout=30_000,
+        )
+    except PWTimeoutError:
+        print(f"[{label}] report criteria not ready after 30s")
+
+    # set filters + dates and click "show report" in one round-trip;
+    # values are set + events dispatched so the site commits them
+    start, end = await page.evaluate(
+        "(args) => window.__setupAndOpen(args)",
+        {"locs": locations, "date": date_str, "posClasses": pos_classes},
     )
+    print(f"[{label}] start:", start)
+    print(f"[{label}] end:", end)
+    await page.locator("#report-view-back-btn").wait_for(state="visible", timeout=180_000)
+
+
+def send_via_smtp(subject: str, body: str, to_email: str, attachments: list[str]) -> None:
+    host = os.environ["SMTP_HOST"]
+    port = int(os.environ.get("SMTP_PORT", "587"))
+    user = os.environ.get("SMTP_USER")
+
+    msg = EmailMessage()
+    msg["From"] = os.environ.get("SMTP_SENDER") or os.environ["SMTP_USER"]
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    msg.set_content(body)
+    for file_path in attachments:
+        path = Path(file_path)
+        subtype = "pdf" if path.suffix.lower() == ".pdf" else "octet-stream"
+        msg.add_attachment(path.read_bytes(), maintype="application", subtype=subtype, filename=path.name)
+
+    # 465 is implicit TLS; anything else (587) upgrades with STARTTLS
+    smtp_cls = smtplib.SMTP_SSL if port == 465 else smtplib.SMTP
+    with smtp_cls(host, port, timeout=60) as server:
+        if port != 465:
+            server.starttls()
+        if user:
+            server.login(user, os.environ["SMTP_PASS"])
+        server.send_message(msg)
+    print(f"Email sent via SMTP ({host})")
+
+
+@lru_cache(maxsize=1)
+def _outlook():
+    # early-bound dispatch, generated once and reused for the process lifetime
+    return win32com.client.gencache.EnsureDispatch("Outlook.Application")
 
 
 def send_via_outlook(subject: str, body: str, to_email: str, attachments: list[str]) -> None:
-    outlook = win32com.client.Dispatch("Outlook.Application")
-    mail = outlook.CreateItem(0)
+    mail = _outlook().CreateItem(0)
     mail.To = to_email
     mail.Subject = subject
     mail.Body = body
@@ -49,160 +352,348 @@ def send_via_outlook(subject: str, body: str, to_email: str, attachments: list[s
     print("Email sent via Outlook")
 
 
-def open_report_view(page) -> None:
-    page.locator("#report-criteria").get_by_role("link", name=" הצג דוח").click()
-    page.locator("#report-view-back-btn").wait_for(state="visible", timeout=180_000)
+async def _mark(target, name: str) -> None:
+    await target.evaluate("(n) => performance.mark(n)", name)
+
+
+async def _log_marks(target, label: str) -> None:
+    marks = await target.evaluate("() => window.__marks || []")
+    prev = None
+    for name, ts in marks:
+        delta = f" (+{ts - prev:,.0f} ms)" if prev is not None else ""
+        print(f"  [{label}] {name}: {ts:,.0f} ms{delta}")
+        prev = ts
+
+
+def _write_chunk(f, data: str, base64_encoded: bool) -> int:
+    return f.write(base64.b64decode(data) if base64_encoded else data.encode("latin-1"))
 
 
-def _extract_pdf_from_frame_html(target) -> bytes | None:
+async def _stream_pdf(cdp, save_path: Path) -> int:
+    # streamed rather than returned inline, so the PDF is never held whole in memory
+    result = await cdp.send("Page.printToPDF", {**CDP_PDF_PARAMS, "transferMode": "ReturnAsStream"})
+    handle = result["stream"]
+    loop = asyncio.get_running_loop()
+    size = 0
+    try:
+        with save_path.open("wb") as f:
+            # write chunk N on the pool while CDP reads chunk N+1
+            pending = None
+            while True:
+                chunk = await cdp.send("IO.read", {"handle": handle, "size": PDF_STREAM_CHUNK_SIZE})
+                if pending:
+                    size += await pending
+                    pending = None
+                if chunk["data"]:
+                    pending = loop.run_in_executor(
+                        _IO_POOL, _write_chunk, f, chunk["data"], chunk.get("base64Encoded", False)
+                    )
+                if chunk.get("eof"):
+                    break
+            if pending:
+                size += await pending
+    finally:
+        await cdp.send("IO.close", {"handle": handle})
+    return size
+
+
+async def _print_via_weasyprint(target, save_path: Path) -> None:
+    html = await target.content()
+    proc = await asyncio.create_subprocess_exec(
+        "weasyprint", "--base-url", target.url, "-", str(save_path),
+        stdin=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate(html.encode("utf-8"))
+    if proc.returncode != 0:
+        raise RuntimeError(f"weasyprint failed ({proc.returncode}): {stderr.decode(errors='replace')}")
+
+
+async def _print_via_cdp_html(target, cdp, save_path: Path) -> Path | None:
     """
     Stimulsoft writes print-ready HTML directly into stiPrintReportFrame
-    (src=about:blank). Extract that HTML, load it into a clean temporary page
-    with no viewer chrome, and generate a proper PDF from it.
+    (src=about:blank). Move that document into the top-level page in-browser
+    (so the HTML never crosses the Playwright bridge), then render it with
+    PDF_ENGINE over target's CDP session. Returns the path written (an
+    .mhtml file for PDF_ENGINE=mhtml).
     """
-    sti_frame = target.frame(name="stiPrintReportFrame")
-    if sti_frame is None:
-        el = target.query_selector("#stiPrintReportFrame")
-        if el:
-            sti_frame = el.content_frame()
-
-    if sti_frame is None:
+    # about:blank frames share the parent's process, so there is no separate
+    # CDP target to attach to; adopting the frame's root gives the same result
+    moved = await target.evaluate("() => window.__adoptPrintFrame()")
+    if not moved:
         print("  stiPrintReportFrame not found")
         return None
+    await target.add_style_tag(content=PDF_PRINT_CSS)
+    await _mark(target, "frame_adopted")
+
+    started = time.perf_counter()
+    if PDF_ENGINE == "weasyprint":
+        await _print_via_weasyprint(target, save_path)
+        out_path = save_path
+    elif PDF_ENGINE == "mhtml":
+        # archival snapshot: skips Chrome's paginator entirely
+        out_path = save_path.with_suffix(".mhtml")
+        snapshot = await cdp.send("Page.captureSnapshot", {"format": "mhtml"})
+        out_path.write_text(snapshot["data"], encoding="utf-8", newline="")
+    else:
+        await _stream_pdf(cdp, save_path)
+        out_path = save_path
+    await _mark(target, "pdf_returned")
+    print(
+        f"  {PDF_ENGINE} from frame: {out_path.stat().st_size:,} bytes"
+        f" in {time.perf_counter() - started:.2f}s"
+    )
+    return out_path
 
-    html = sti_frame.content()
-    print(f"  frame HTML: {len(html):,} chars")
 
-    temp_page = target.context.new_page()
-    try:
-        temp_page.set_content(html, wait_until="domcontentloaded")
-        temp_page.wait_for_timeout(500)
-        pdf_bytes = temp_page.pdf(
-            print_background=False,
-            prefer_css_page_size=True,
-        )
-        print(f"  PDF from frame HTML: {len(pdf_bytes):,} bytes")
-        return pdf_bytes
-    finally:
-        temp_page.close()
+async def _print_via_popup_blob(target, cdp, save_path: Path) -> Path | None:
+    """
+    Fetch the PDF the Stimulsoft viewer exposes as a blob: URL (in an
+    embed/object/iframe, or as the popup's own URL) and save it as-is.
+    """
+    data = await target.evaluate("() => window.__blobPdfBase64()")
+    if not data:
+        print("  no blob: PDF found")
+        return None
+    save_path.write_bytes(base64.b64decode(data))
+    return save_path
+
+
+async def _print_via_page_pdf(target, cdp, save_path: Path) -> Path:
+    # captures viewer chrome but always produces output
+    await target.add_style_tag(content=PDF_PRINT_CSS)
+    await target.pdf(
+        path=str(save_path),
+        print_background=CDP_PDF_PARAMS["printBackground"],
+        prefer_css_page_size=CDP_PDF_PARAMS["preferCSSPageSize"],
+        width=f'{CDP_PDF_PARAMS["paperWidth"]}in',
+        height=f'{CDP_PDF_PARAMS["paperHeight"]}in',
+        margin={
+            "top": f"{PDF_MARGIN_IN}in",
+            "bottom": f"{PDF_MARGIN_IN}in",
+            "left": f"{PDF_MARGIN_IN}in",
+            "right": f"{PDF_MARGIN_IN}in",
+        },
+    )
+    return save_path
+
+
+# print strategies, in retry fallback order
+STRATEGIES = {
+    "cdp_html": _print_via_cdp_html,
+    "popup_blob": _print_via_popup_blob,
+    "page_pdf": _print_via_page_pdf,
+}
+PRINT_STRATEGY = os.environ.get("PRINT_STRATEGY", "cdp_html")
+if PRINT_STRATEGY not in STRATEGIES:
+    raise ValueError(f"Unknown PRINT_STRATEGY {PRINT_STRATEGY!r}; expected one of {', '.join(STRATEGIES)}")
+
+
+def retry_delay(attempt: int) -> float:
+    # exponential backoff with jitter, so scheduled runs don't retry in lockstep
+    backoff = min(RETRY_DELAY_SECONDS * 2 ** (attempt - 1), RETRY_MAX_DELAY_SECONDS)
+    return backoff + random.uniform(0, RETRY_DELAY_SECONDS)
+
 
+def next_strategy(strategy: str) -> str:
+    # after a failed print step, fall back to the next strategy (page_pdf is last)
+    order = list(STRATEGIES)
+    return order[min(order.index(strategy) + 1, len(order) - 1)]
 
-def print_then_save_pdf(context, page, save_path: Path) -> None:
+
+async def print_then_save_pdf(page, cdp, save_path: Path, strategy: str = PRINT_STRATEGY) -> Path:
     """
-    Click 'Print' to open the Stimulsoft viewer popup, extract the PDF from
-    the blob URL the viewer creates, and save it directly.
-    Falls back to page.pdf() if blob extraction fails.
+    Click 'Print' to open the Stimulsoft print output (inline or in a popup)
+    and save it with the given print strategy. cdp is page's CDP session;
+    a popup gets its own.
+    Falls back to page.pdf() if the strategy produces nothing.
+    Returns the path actually written (see PDF_ENGINE).
     """
     popup = None
     try:
-        with context.expect_page(timeout=5_000) as popup_info:
-            page.get_by_role("cell", name="Print").nth(2).click()
-        popup = popup_info.value
+        async with page.context.expect_page(timeout=5_000) as popup_info:
+            await page.get_by_role("cell", name="Print").nth(2).click()
+        popup = await popup_info.value
     except PWTimeoutError:
         try:
-            page.get_by_text("Print", exact=True).click(timeout=2_000)
+            await page.get_by_text("Print", exact=True).click(timeout=2_000)
         except Exception:
             pass
 
     target = popup if popup else page
+    target_cdp = await popup.context.new_cdp_session(popup) if popup else cdp
+    await _mark(target, "click_print")
 
     try:
-        target.wait_for_load_state("domcontentloaded", timeout=60_000)
+        await target.wait_for_load_state("domcontentloaded", timeout=60_000)
     except PWTimeoutError:
         pass
+    # no networkidle wait: the Stimulsoft viewer keeps a long-polling
+    # connection open, so it would only ever time out
     try:
-        target.wait_for_load_state("networkidle", timeout=60_000)
+        await target.wait_for_selector(
+            "#stiPrintReportFrame" if popup is None else "#stiPrintReportFrame, embed, object, iframe",
+            state="attached",
+            timeout=30_000,
+        )
     except PWTimeoutError:
-        pass
-    # Extra time for Stimulsoft to finish generating the PDF blob
-    target.wait_for_timeout(3_000)
-
-    # Attempt 1: extract clean HTML from stiPrintReportFrame and render to PDF
-    pdf_bytes = _extract_pdf_from_frame_html(target)
-    if pdf_bytes:
-        save_path.write_bytes(pdf_bytes)
-        print(f"PDF saved from frame HTML ({len(pdf_bytes):,} bytes)")
+        print("  print output element not attached after 30s")
+    await _mark(target, "iframe_attached")
+    # Wait for Stimulsoft to finish writing the print HTML (or, in a popup,
+    # the PDF viewer element) instead of sleeping a fixed amount
+    try:
+        await target.wait_for_function(
+            _PRINT_READY_JS,
+            arg=popup is not None,
+            timeout=30_000,
+        )
+    except PWTimeoutError:
+        print("  Stimulsoft print output not ready after 30s")
+    await _mark(target, "frame_ready")
+
+    try:
+        out_path = await STRATEGIES[strategy](target, target_cdp, save_path)
+    except Exception as e:
+        raise PrintError(f"{strategy} failed for {save_path.stem}: {e}") from e
+    if out_path:
+        print(f"Saved via {strategy}: {out_path}")
     else:
-        # Fallback: page.pdf() — captures viewer chrome but always produces output
-        print("Frame extraction failed, falling back to page.pdf()")
-        target.pdf(path=str(save_path), print_background=True, prefer_css_page_size=True)
+        print(f"{strategy} failed, falling back to page.pdf()")
+        out_path = await _print_via_page_pdf(target, target_cdp, save_path)
+
+    await _log_marks(target, save_path.stem)
 
     if popup:
-        popup.close()
+        await target_cdp.detach()
+        await popup.close()
 
-    if not save_path.exists() or save_path.stat().st_size < 5_000:
+    if not out_path.exists() or out_path.stat().st_size < 5_000:
         Path("debug").mkdir(exist_ok=True)
-        page.screenshot(path="debug/print_pdf_too_small_or_missing.png", full_page=True)
-        raise RuntimeError(f"PDF missing/too small after print->pdf: {save_path}")
-
-
-def run() -> None:
-    # ---- creds from ENV (do not hardcode) ----
-    pres_code = os.environ["PRES_POS_CODE"]
-    pres_username = os.environ["NLC_USER"]
-    pres_password = os.environ["NLC_PASSWORD"]
+        await page.screenshot(path=f"debug/{save_path.stem}_pdf_too_small_or_missing.png", full_page=True)
+        raise PrintError(f"PDF missing/too small after print->pdf: {out_path}")
 
-    out_dir = Path(os.environ.get("PRES_OUT_DIR", "downloads")).resolve()
-    out_dir.mkdir(parents=True, exist_ok=True)
+    return out_path
 
-    file_meznon = out_dir / "מזנון.pdf"
-    file_kupot = out_dir / "קופות.pdf"
 
-    date_str = yesterday_str_il("%d/%m/%Y")
+async def open_daily_report(page) -> None:
+    await page.get_by_text("הנהלת חשבונות", exact=True).click()
+    await page.get_by_role("link", name="דוחות ").click()
+    await page.get_by_role("link", name="דוח יומי").click()
+    await expect(page.locator("#report-criteria")).to_be_visible(timeout=30_000)
 
-    with sync_playwright() as p:
-        # MUST be headless for PDF generation
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
-            viewport={"width": 1400, "height": 900},
-            accept_downloads=True,
-        )
-        page = context.new_page()
 
-        # login
-        page.goto(PRES_URL, wait_until="domcontentloaded")
-        page.get_by_role("textbox", name="קוד").fill(pres_code)
-        page.get_by_role("textbox", name="שם משתמש").fill(pres_username)
-        page.get_by_role("textbox", name="סיסמא").fill(pres_password)
-        page.get_by_role("button", name="היכנס").click()
-        expect(page.get_by_text("הנהלת חשבונות", exact=True)).to_be_visible(timeout=30_000)
+async def render_report(
+    browser,
+    storage: dict,
+    pos_classes: list[str],
+    date_str: str,
+    save_path: Path,
+    strategy: str = PRINT_STRATEGY,
+) -> Path:
+    """
+    Render one report in its own BrowserContext, seeded with the logged-in
+    storage_state, so several reports can render side by side.
+    """
+    context = await new_context(browser, storage)
+    await context.add_init_script(_PERF_MARKS_JS + _PAGE_HELPERS_JS)
+    try:
+        page = await context.new_page()
+        # one CDP session per report page, attached up front and reused for printing
+        cdp = await context.new_cdp_session(page)
+        await page.goto(PRES_URL, wait_until="domcontentloaded")
+        try:
+            await expect(page.get_by_text("הנהלת חשבונות", exact=True)).to_be_visible(timeout=30_000)
+        except AssertionError as e:
+            raise AuthError(f"Saved session rejected while opening {save_path.stem}") from e
 
         # navigate
-        page.get_by_text("הנהלת חשבונות", exact=True).click()
-        page.get_by_role("link", name="דוחות ").click()
-        page.get_by_role("link", name="דוח יומי").click()
-        expect(page.locator("#report-criteria")).to_be_visible(timeout=30_000)
-
-        # filters
-        page.locator('select[name="filterLocations"]').select_option(
-            ["1181", "1178", "1170", "1350", "1174", "1175", "1176", "1173"]
-        )
+        await open_daily_report(page)
 
-        set_date_input(page, 'input[name="startDatePicker"]', date_str)
-        set_date_input(page, 'input[name="endDatePicker"]', date_str)
+        # filters + dates + open the report view
+        await setup_and_open_report(page, REPORT_LOCATIONS, date_str, pos_classes, save_path.stem)
+        return await print_then_save_pdf(page, cdp, save_path, strategy)
+    finally:
+        await context.close()
 
-        print("start:", page.locator('input[name="startDatePicker"]').input_value())
-        print("end:", page.locator('input[name="endDatePicker"]').input_value())
 
-        # ---- report 1: מזנון (posClasses=3) ----
-        page.locator('select[name="posClasses"]').select_option("3")
-        open_report_view(page)
-        print_then_save_pdf(context, page, file_meznon)
+async def login(browser) -> dict:
+    """
+    Return a logged-in storage_state, reusing the one saved on disk when it
+    is fresh and still accepted, and performing the full login otherwise.
+    """
+    cached = _fresh_auth_state()
+    context = await new_context(browser, cached)
+    try:
+        page = await context.new_page()
+        await page.goto(PRES_URL, wait_until="domcontentloaded")
+
+        if cached:
+            try:
+                await expect(page.get_by_text("הנהלת חשבונות", exact=True)).to_be_visible(timeout=10_000)
+                print("Reusing saved login session")
+                return await context.storage_state()
+            except AssertionError:
+                # session expired - the site redirected us to the login form
+                print("Saved login session expired, logging in again")
+
+        # ---- creds from ENV (do not hardcode) ----
+        pres_code = os.environ["PRES_POS_CODE"]
+        pres_username = os.environ["NLC_USER"]
+        pres_password = os.environ["NLC_PASSWORD"]
+
+        await page.get_by_role("textbox", name="קוד").fill(pres_code)
+        await page.get_by_role("textbox", name="שם משתמש").fill(pres_username)
+        await page.get_by_role("textbox", name="סיסמא").fill(pres_password)
+        await page.get_by_role("button", name="היכנס").click()
+        try:
+            await expect(page.get_by_text("הנהלת חשבונות", exact=True)).to_be_visible(timeout=30_000)
+        except AssertionError as e:
+            # only the site's own wrong-credentials message is fatal; a slow
+            # auth POST or a server error page stays retryable
+            if await page.get_by_text(LOGIN_ERROR_RE).first.is_visible():
+                raise LoginError("Login failed: credentials rejected") from e
+            raise
+
+        AUTH_STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        return await context.storage_state(path=AUTH_STATE_PATH)
+    finally:
+        await context.close()
 
-        # back
-        page.locator("#report-view-back-btn").click()
-        expect(page.locator("#report-criteria")).to_be_visible(timeout=30_000)
 
-        # ---- report 2: קופות (posClasses=[1,4,2,5]) ----
-        page.locator('select[name="posClasses"]').select_option(["1", "4", "2", "5"])
-        open_report_view(page)
-        print_then_save_pdf(context, page, file_kupot)
+async def run(browser, strategy: str = PRINT_STRATEGY) -> None:
+    out_dir = Path(os.environ.get("PRES_OUT_DIR", "downloads")).resolve()
+    out_dir.mkdir(parents=True, exist_ok=True)
 
-        context.close()
-        browser.close()
+    file_meznon = out_dir / "מזנון.pdf"
+    file_kupot = out_dir / "קופות.pdf"
 
-    # send via Outlook (desktop must be installed/logged-in)
-    send_via_outlook(
+    date_str = yesterday_str_il("%d/%m/%Y")
+
+    # cookies/localStorage shared by the per-report contexts
+    storage = await login(browser)
+
+    # ---- מזנון (posClasses=3) and קופות (posClasses=[1,4,2,5]) render in parallel ----
+    tasks = [
+        asyncio.create_task(
+            render_report(browser, storage, ["3"], date_str, file_meznon, strategy)
+        ),
+        asyncio.create_task(
+            render_report(browser, storage, ["1", "4", "2", "5"], date_str, file_kupot, strategy)
+        ),
+    ]
+    try:
+        file_meznon, file_kupot = await asyncio.gather(*tasks)
+    except BaseException:
+        # gather leaves the sibling running; stop it before the next attempt
+        # (or browser.close()) so it can't keep writing its output file
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # send via SMTP when configured, otherwise Outlook (desktop must be installed/logged-in)
+    send = send_via_smtp if os.environ.get("SMTP_HOST") else send_via_outlook
+    send(
         subject=SUBJECT,
         body="Attached are the two reports: מזנון and קופות.",
         to_email=RECIPIENT,
@@ -212,21 +703,52 @@ def run() -> None:
     print(f"Done:\n- {file_meznon}\n- {file_kupot}")
 
 
-if __name__ == "__main__":
-    last_error = None
-    for attempt in range(1, MAX_RETRIES + 1):
+async def launch_browser(p):
+    # MUST be headless for PDF generation
+    return await p.chromium.launch(headless=True, args=CHROMIUM_ARGS, chromium_sandbox=False)
+
+
+async def main() -> None:
+    check_config()
+
+    # one browser for every attempt; each attempt only opens fresh contexts
+    async with async_playwright() as p:
+        browser = await launch_browser(p)
         try:
-            print(f"Attempt {attempt}/{MAX_RETRIES}...")
-            run()
-            print("Success.")
-            break
-        except Exception as e:
-            last_error = e
-            print(f"Attempt {attempt}/{MAX_RETRIES} failed: {e}")
-            if attempt < MAX_RETRIES:
-                print(f"Retrying in {RETRY_DELAY_SECONDS} seconds...")
-                time.sleep(RETRY_DELAY_SECONDS)
-    else:
-        raise RuntimeError(
-            f"Script failed after {MAX_RETRIES} attempts. Last error: {last_error}"
-        ) from last_error
+            last_error = None
+            strategy = PRINT_STRATEGY
+            for attempt in range(1, MAX_RETRIES + 1):
+                try:
+                    print(f"Attempt {attempt}/{MAX_RETRIES} ({strategy})...")
+                    if not browser.is_connected():
+                        browser = await launch_browser(p)
+                    await run(browser, strategy)
+                    print("Success.")
+                    break
+                except Exception as e:
+                    last_error = e
+                    print(f"Attempt {attempt}/{MAX_RETRIES} failed: {e!r}")
+                    # keep the saved session on transient failures; only drop it when
+                    # the site actually rejected it
+                    if isinstance(e, AuthError):
+                        AUTH_STATE_PATH.unlink(missing_ok=True)
+                    if isinstance(e, FATAL_ERRORS):
+                        print("Not retrying: error is not transient")
+                        raise
+                    # only a failed print step says anything about the strategy
+                    if isinstance(e, PrintError):
+                        strategy = next_strategy(strategy)
+                    if attempt < MAX_RETRIES:
+                        delay = retry_delay(attempt)
+                        print(f"Retrying in {delay:.1f} seconds...")
+                        await asyncio.sleep(delay)
+            else:
+                raise RuntimeError(
+                    f"Script failed after {MAX_RETRIES} attempts. Last error: {last_error}"
+                ) from last_error
+        finally:
+            await browser.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())